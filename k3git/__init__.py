@@ -17,8 +17,12 @@ __name__ = "k3git"
 from .gitopt import GitOpt
 from .giturl import GitUrl
 from .git_wrapper import Git
+from .objsession import ObjSession
+from .treeeditor import TreeEditor
 
 __all__ = [
     'Git',
     'GitOpt',
+    'ObjSession',
+    'TreeEditor',
 ]
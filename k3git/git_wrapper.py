@@ -6,14 +6,33 @@ import os
 
 from k3handy import cmdf
 from k3handy import pabs
+from k3proc import CalledProcessError
+from k3proc import command
 from k3str import to_utf8
 
+from .objsession import ObjSession
+from .objsession import _quote_path
+from .treeeditor import TreeEditor
+
 logger = logging.getLogger(__name__)
 
 
 class Git(object):
+    """
+    Git wraps git command-line.
+
+    With ``objsession=True``, object queries: ``rev_of``, ``obj_type``,
+    ``tree_of`` and ``tree_items`` are answered by a long-lived
+    ``git cat-file --batch`` session instead of forking a git process for
+    every call. Call ``close()`` or use it as a context manager to shut the
+    session down::
 
-    def __init__(self, opt, gitpath=None, gitdir=None, working_dir=None, cwd=None, ctxmsg=None):
+        with Git(GitOpt(), cwd='/foo', objsession=True) as g:
+            g.rev_of('HEAD')
+    """
+
+    def __init__(self, opt, gitpath=None, gitdir=None, working_dir=None, cwd=None, ctxmsg=None,
+                 objsession=False):
         self.opt = opt.clone()
         # gitdir and working_dir is specified and do not consider '-C' option
         if gitdir is not None:
@@ -26,6 +45,35 @@ class Git(object):
         self.gitpath = gitpath or "git"
         self.ctxmsg = ctxmsg
 
+        self.objsession = None
+        if objsession:
+            self.objsession_start()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        """
+        Shutdown the object session if there is one.
+        """
+        if self.objsession is not None:
+            self.objsession.close()
+            self.objsession = None
+
+    # object session
+
+    def objsession_start(self):
+        """
+        Start routing object queries through a ``cat-file --batch`` session.
+        The coprocesses are not started until the first query.
+        """
+        if self.objsession is None:
+            self.objsession = ObjSession([self.gitpath] + self._args(), cwd=self.cwd)
+        return self.objsession
+
     # high level API
 
     def checkout(self, branch, flag='x'):
@@ -131,9 +179,39 @@ class Git(object):
     def blob_new(self, f, flag=''):
         return self.cmdf("hash-object", "-w", f, flag=flag + 'n0')
 
+    def blob_read(self, name, flag=''):
+        """
+        Read the content of a blob, such as ``HEAD:README.md``.
+
+        Returns:
+            str: blob content. ``None`` if there is no such blob.
+        """
+        if self.objsession is not None:
+            rst = self.objsession.read(name)
+            if rst is None or rst[1] != 'blob':
+                return self._objsession_notfound(name, flag)
+            return rst[2].decode('utf-8')
+
+        # Not cmdf(): it splits stdout into lines and loses whether the blob
+        # ends with a newline.
+        code, out, _ = command(self.gitpath, *self._args(), "cat-file", "blob", name,
+                               check='x' in flag, **self._opt())
+        if code != 0:
+            return None
+        return out
+
+    def blob_new_content(self, content, flag=''):
+        """
+        Write ``content`` as a blob and return its hash.
+        """
+        return self.cmdf("hash-object", "-w", "--stdin", input=content, flag=flag + 'n0')
+
     #  tree
 
     def tree_of(self, commit, flag=''):
+        if self.objsession is not None:
+            return self._objsession_info(commit + "^{tree}", 0, flag)
+
         return self.cmdf("rev-parse", commit + "^{tree}", flag=flag + 'n0')
 
     def tree_commit(self, treeish, commit_message, parent_commits, flag='x'):
@@ -157,32 +235,18 @@ class Git(object):
 
         if with_size:
             args.append("--long")
-        return self.cmdf("ls-tree", treeish, *args, flag=flag + 'no')
-
-    def tree_add_obj(self, cur_tree, path, treeish):
-
-        sep = os.path.sep
-
-        itms = self.tree_items(cur_tree)
-
-        if sep not in path:
-            return self.tree_new_replace(itms, path, treeish, flag='x')
 
-        # a/b/c -> a, b/c
-        p0, left = path.split(sep, 1)
-        p0item = self.tree_find_item(cur_tree, fn=p0, typ="tree")
+        if self.objsession is not None:
+            return self._objsession_tree_items(treeish, name_only, with_size, flag)
 
-        if p0item is None:
-
-            newsubtree = treeish
-            for p in reversed(left.split(sep)):
-                newsubtree = self.tree_new_replace([], p, newsubtree, flag='x')
-        else:
-
-            subtree = p0item["object"]
-            newsubtree = self.tree_add_obj(subtree, left, treeish)
+        return self.cmdf("ls-tree", treeish, *args, flag=flag + 'no')
 
-        return self.tree_new_replace(itms, p0, newsubtree, flag='x')
+    def tree_add_obj(self, cur_tree, path, treeish):
+        """
+        Put ``treeish`` at ``path`` in tree ``cur_tree`` and return the new root
+        tree. See ``TreeEditor`` for applying more than one edit at a time.
+        """
+        return TreeEditor(self, cur_tree).add(path, treeish).write()
 
     def tree_find_item(self, treeish, fn=None, typ=None):
         for itm in self.tree_items(treeish):
@@ -280,11 +344,86 @@ class Git(object):
         Returns:
             str: sha256 in lower-case hex. If no such object is found, it returns None.
         """
+        if self.objsession is not None:
+            return self._objsession_info(name, 0, flag)
+
         return self.cmdf("rev-parse", "--verify", "--quiet", name, flag=flag + 'n0')
 
     def obj_type(self, obj, flag=''):
+        if self.objsession is not None:
+            return self._objsession_info(obj, 1, flag)
+
         return self.cmdf("cat-file", "-t", obj, flag=flag + 'n0')
 
+    # object session backed queries
+
+    def _objsession_info(self, name, field, flag):
+        rst = self.objsession.info(name)
+        if rst is None:
+            return self._objsession_notfound(name, flag)
+        return rst[field]
+
+    def _objsession_tree_items(self, treeish, name_only, with_size, flag):
+
+        # Do not append "^{tree}" to treeish: "<commit>:<path>^{tree}" is
+        # parsed as path "<path>^{tree}".
+        rst = self.objsession.read(treeish)
+        while rst is not None and rst[1] in ('commit', 'tag'):
+            # the first line of a commit is "tree <oid>", of a tag is "object <oid>"
+            first_line = rst[2].split(b'\n', 1)[0]
+            rst = self.objsession.read(first_line.split(b' ')[1].decode())
+
+        if rst is None or rst[1] != 'tree':
+            return self._objsession_notfound(treeish, flag)
+
+        _, _, cont = rst
+
+        # raw tree entry:
+        #     <mode> SP <name> NUL <binary hash>
+        # hash length is 20 for sha1 and 32 for sha256.
+        hashlen = len(rst[0]) // 2
+
+        lines = []
+        i = 0
+        while i < len(cont):
+            sp = cont.index(b' ', i)
+            nul = cont.index(b'\0', sp)
+
+            mode = cont[i:sp].decode()
+            fn = _quote_path(cont[sp + 1:nul])
+            obj = cont[nul + 1:nul + 1 + hashlen].hex()
+            i = nul + 1 + hashlen
+
+            if name_only:
+                lines.append(fn)
+                continue
+
+            mode = mode.rjust(6, '0')
+            if mode == '040000':
+                typ = 'tree'
+            elif mode == '160000':
+                typ = 'commit'
+            else:
+                typ = 'blob'
+
+            if with_size:
+                if typ == 'blob':
+                    size = str(self.objsession.info(obj)[2])
+                else:
+                    size = '-'
+                lines.append('{} {} {} {:>7}\t{}'.format(mode, typ, obj, size, fn))
+            else:
+                lines.append('{} {} {}\t{}'.format(mode, typ, obj, fn))
+
+        return lines
+
+    def _objsession_notfound(self, name, flag):
+        if 'x' in flag:
+            raise CalledProcessError(128, '', 'fatal: Not a valid object name ' + name,
+                                     [self.gitpath] + self._args() + ['cat-file', '--batch'],
+                                     self._opt())
+        return None
+
     # wrapper of cli
 
     def _opt(self, **kwargs):
@@ -0,0 +1,168 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+import logging
+import subprocess
+import threading
+
+from k3proc import CalledProcessError
+from k3str import to_bytes
+
+logger = logging.getLogger(__name__)
+
+obj_types = ('blob', 'tree', 'commit', 'tag')
+
+
+class ObjSession(object):
+    """
+    ObjSession keeps a long-lived ``git cat-file --batch-check`` and a
+    ``git cat-file --batch`` coprocess for one git-dir and answers object
+    queries over their pipes.
+
+    Each process is started on its first query and lives until ``close()``.
+    Queries are serialized by a lock thus a session can be shared by threads.
+
+    E.g.::
+
+        s = ObjSession(['git', '--git-dir=/foo'])
+        s.info('HEAD')              # ('c3954c...', 'commit', 201)
+        s.read('HEAD^{tree}')       # ('87486e...', 'tree', b'100644 .gift\\0...')
+        s.close()
+    """
+
+    def __init__(self, cmd, cwd=None):
+        """
+        Args:
+            cmd(list): git executable and global options,
+                e.g. ``['git', '--git-dir=/foo']``.
+
+            cwd(str): the working dir to start git in.
+        """
+        self.cmd = list(cmd)
+        self.cwd = cwd
+        self.procs = {}
+        self.lock = threading.Lock()
+
+    def info(self, name):
+        """
+        Query object type and size with ``cat-file --batch-check``.
+
+        Args:
+            name(str): any object name ``git rev-parse`` understands, such as
+                ``HEAD``, ``master^{tree}`` or a hash.
+
+        Returns:
+            (str, str, int): object hash, type and size.
+            ``None`` if the object is not found.
+        """
+        with self.lock:
+            return self._query('--batch-check', name)
+
+    def read(self, name):
+        """
+        Read object content with ``cat-file --batch``.
+
+        Returns:
+            (str, str, bytes): object hash, type and raw content.
+            ``None`` if the object is not found.
+        """
+        with self.lock:
+            return self._query('--batch', name)
+
+    def close(self):
+        """
+        Shutdown all coprocesses. It is safe to call it more than once.
+        """
+        with self.lock:
+            procs, self.procs = self.procs, {}
+
+        for p in procs.values():
+            try:
+                p.stdin.close()
+            except OSError:
+                pass
+            p.wait()
+            p.stdout.close()
+
+    def _proc(self, mode):
+        p = self.procs.get(mode)
+        if p is None:
+            p = subprocess.Popen(self.cmd + ['cat-file', mode],
+                                 stdin=subprocess.PIPE,
+                                 stdout=subprocess.PIPE,
+                                 stderr=subprocess.DEVNULL,
+                                 cwd=self.cwd)
+            self.procs[mode] = p
+        return p
+
+    def _query(self, mode, name):
+
+        # a name with line break would break the line based protocol.
+        if '\n' in name or name == '':
+            return None
+
+        p = self._proc(mode)
+        try:
+            p.stdin.write(to_bytes(name) + b'\n')
+            p.stdin.flush()
+        except BrokenPipeError:
+            raise self._dead(mode)
+
+        line = p.stdout.readline()
+        if line == b'':
+            raise self._dead(mode)
+
+        # <oid> SP <type> SP <size> LF
+        # or
+        # <object> SP missing LF
+        elts = line.decode('utf-8', 'surrogateescape').rstrip('\n').split(' ')
+        if len(elts) != 3 or elts[1] not in obj_types or not elts[2].isdigit():
+            return None
+
+        oid, typ, size = elts[0], elts[1], int(elts[2])
+        if mode == '--batch-check':
+            return oid, typ, size
+
+        # content followed by a LF
+        cont = p.stdout.read(size + 1)
+        if len(cont) != size + 1:
+            raise self._dead(mode)
+
+        return oid, typ, cont[:-1]
+
+    def _dead(self, mode):
+        p = self.procs.pop(mode)
+        code = p.wait()
+        return CalledProcessError(code, '', 'git cat-file {} exited'.format(mode),
+                                  self.cmd + ['cat-file', mode], {'cwd': self.cwd})
+
+
+def _quote_path(fn):
+    """
+    Quote a raw file name in bytes the same way ``git ls-tree`` does with the
+    default ``core.quotePath=true``: a name with control chars, ``"``, ``\\``
+    or non-ascii bytes is wrapped in double quotes with C-style escapes.
+    """
+
+    escapes = {
+        0x07: '\\a', 0x08: '\\b', 0x09: '\\t', 0x0a: '\\n',
+        0x0b: '\\v', 0x0c: '\\f', 0x0d: '\\r',
+        0x22: '\\"', 0x5c: '\\\\',
+    }
+
+    quoted = False
+    rst = []
+    for c in fn:
+        if c in escapes:
+            rst.append(escapes[c])
+            quoted = True
+        elif c < 0x20 or c >= 0x7f:
+            rst.append('\\{:03o}'.format(c))
+            quoted = True
+        else:
+            rst.append(chr(c))
+
+    rst = ''.join(rst)
+    if quoted:
+        rst = '"' + rst + '"'
+    return rst
@@ -7,6 +7,7 @@ from k3fs import fread
 from k3fs import fwrite
 from k3git import Git
 from k3git import GitOpt
+from k3git import TreeEditor
 from k3handy import CalledProcessError
 from k3handy.cmd import cmd0
 from k3handy.cmd import cmdf
@@ -304,6 +305,25 @@ class TestGitBlob(BaseTest):
         content = cmd0(origit, "cat-file", "-p", blobhash, cwd=superp)
         self.assertEqual("newblob!!!", content)
 
+    def test_blob_new_content(self):
+        g = Git(GitOpt(), cwd=superp)
+        blobhash = g.blob_new_content("newblob!!!")
+
+        content = cmd0(origit, "cat-file", "-p", blobhash, cwd=superp)
+        self.assertEqual("newblob!!!", content)
+
+    def test_blob_read(self):
+        for objsession in (False, True):
+            with Git(GitOpt(), cwd=superp, objsession=objsession) as g:
+                self.assertEqual("superman\n", g.blob_read("master:imsuperman"))
+                self.assertIsNone(g.blob_read("master:foo"))
+                self.assertIsNone(g.blob_read("master"))
+                self.assertRaises(CalledProcessError, g.blob_read, "master:foo", flag='x')
+
+                for content in ("no-eol", "two\n\n", ""):
+                    blobhash = g.blob_new_content(content)
+                    self.assertEqual(content, g.blob_read(blobhash))
+
 
 class TestGitTree(BaseTest):
 
@@ -506,6 +526,113 @@ class TestGitTreeItem(BaseTest):
         self.assertEqual('100755 blob 15d2fff1101916d7212371fea0f3a82bda750f6c\tfoo', got)
 
 
+class TestGitTreeEditor(BaseTest):
+
+    def test_edits(self):
+        g = Git(GitOpt(), cwd=superp)
+        roottree = g.tree_of("HEAD")
+        blob = g.rev_of("HEAD:imsuperman")
+
+        te = TreeEditor(g, roottree)
+        te.add("nested", roottree)
+        te.add("a/b/c/d", roottree)
+        te.add("a/b/x", blob, mode='100755')
+        te.add("imsuperman/y", blob)
+        te.remove(".gift")
+        te.remove("a/b/c/d/.gift")
+        te.remove("not/exist")
+        newtree = te.write()
+
+        files = cmdout(origit, "ls-tree", "-r", newtree, cwd=superp)
+        self.assertEqual([
+            "100644 blob a668431ae444a5b68953dc61b4b3c30e066535a2\ta/b/c/d/imsuperman",
+            "100755 blob a668431ae444a5b68953dc61b4b3c30e066535a2\ta/b/x",
+            "100644 blob a668431ae444a5b68953dc61b4b3c30e066535a2\timsuperman/y",
+            "100644 blob 15d2fff1101916d7212371fea0f3a82bda750f6c\tnested/.gift",
+            "100644 blob a668431ae444a5b68953dc61b4b3c30e066535a2\tnested/imsuperman",
+        ], files)
+
+        # remove the last entry of a tree removes the tree
+
+        te = TreeEditor(g, newtree)
+        te.remove("a/b/c/d/imsuperman")
+        te.remove("a/b/x")
+        newtree = te.write()
+
+        files = cmdout(origit, "ls-tree", "-r", "--name-only", newtree, cwd=superp)
+        self.assertEqual([
+            "imsuperman/y",
+            "nested/.gift",
+            "nested/imsuperman",
+        ], files)
+
+        # no edit
+
+        self.assertEqual(newtree, TreeEditor(g, newtree).write())
+
+    def test_empty(self):
+        g = Git(GitOpt(), cwd=superp)
+
+        self.assertEqual('4b825dc642cb6eb9a060e54bf8d69288fbee4904',
+                         TreeEditor(g).write())
+
+        roottree = g.tree_of("HEAD")
+        newtree = TreeEditor(g).add("x/y", roottree).write()
+        files = cmdout(origit, "ls-tree", "-r", "--name-only", newtree, cwd=superp)
+        self.assertEqual(["x/y/.gift", "x/y/imsuperman"], files)
+
+    def test_with_objsession(self):
+        with Git(GitOpt(), cwd=superp, objsession=True) as g:
+            roottree = g.tree_of("HEAD")
+            newtree = TreeEditor(g, roottree).add("a/b", roottree).write()
+            self.assertEqual(Git(GitOpt(), cwd=superp).tree_add_obj(roottree, "a/b", roottree),
+                             newtree)
+
+            files = g.tree_items(newtree + ":a/b", name_only=True)
+            self.assertEqual([".gift", "imsuperman"], files)
+
+
+class TestGitObjSession(BaseTest):
+
+    def test_same_as_cmd(self):
+        g = Git(GitOpt(), cwd=superp)
+
+        with Git(GitOpt(), cwd=superp, objsession=True) as gs:
+
+            for name in ('master', 'master~', 'HEAD', 'abc', 'master:imsuperman',
+                         'c3954c897dfe40a5b99b7145820eeb227210265c'):
+                self.assertEqual(g.rev_of(name), gs.rev_of(name), name)
+                self.assertEqual(g.obj_type(name), gs.obj_type(name), name)
+                self.assertEqual(g.tree_of(name), gs.tree_of(name), name)
+
+            roottree = g.tree_of('master')
+            newtree = g.tree_add_obj(roottree, "a/b", roottree)
+
+            for treeish in ('master', roottree, newtree, newtree + ':a'):
+                for kwargs in ({},
+                               {'with_size': True},
+                               {'name_only': True}):
+                    self.assertEqual(g.tree_items(treeish, **kwargs),
+                                     gs.tree_items(treeish, **kwargs))
+
+        self.assertIsNone(gs.objsession)
+
+    def test_flag_x(self):
+        with Git(GitOpt(), cwd=superp, objsession=True) as gs:
+            self.assertRaises(CalledProcessError, gs.rev_of, 'abc', flag='x')
+            self.assertRaises(CalledProcessError, gs.tree_of, 'abc', flag='x')
+            self.assertRaises(CalledProcessError, gs.tree_items, 'abc')
+            self.assertIsNone(gs.tree_items('abc', flag=''))
+
+    def test_quoted_path(self):
+        g = Git(GitOpt(), cwd=superp)
+        blob = g.rev_of('master:imsuperman')
+        tree = g.tree_new(['100644 blob {}\t"\\344\\270\\255 \\t\\"x"'.format(blob)])
+
+        with Git(GitOpt(), cwd=superp, objsession=True) as gs:
+            self.assertEqual(g.tree_items(tree), gs.tree_items(tree))
+
+
 class TestGitOut(BaseTest):
 
     def test_out(self):
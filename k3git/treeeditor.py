@@ -0,0 +1,229 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+import logging
+import subprocess
+
+from k3proc import CalledProcessError
+from k3str import to_bytes
+
+from .objsession import _quote_path
+
+logger = logging.getLogger(__name__)
+
+
+class _TreeNode(object):
+
+    def __init__(self, oid):
+        # oid of the original tree, None for a newly created tree.
+        self.oid = oid
+
+        # fn -> (mode, type, object). None until the tree is loaded.
+        self.entries = None
+
+        # fn -> _TreeNode, the sub trees on an edited path.
+        self.children = {}
+
+        self.dirty = False
+
+
+class TreeEditor(object):
+    """
+    TreeEditor applies any number of path edits to a tree in memory and then
+    writes only the changed trees, bottom-up, through one
+    ``git mktree --batch`` process.
+
+    Only the trees on the edited paths are loaded, with ``Git.tree_items``
+    thus a ``Git`` with an object session loads them without forking.
+
+    E.g.::
+
+        te = TreeEditor(g, g.tree_of('HEAD'))
+        te.add('a/b/c', blob_hash, mode='100755')
+        te.add('foo/bar', tree_hash)
+        te.remove('old/file')
+        newtree = te.write()
+
+    A non-tree entry in the middle of an edited path is replaced with a tree,
+    the same as ``Git.tree_add_obj`` does.
+    """
+
+    def __init__(self, git, treeish=None):
+        """
+        Args:
+            git(Git): the ``Git`` to read trees from and write trees to.
+
+            treeish(str): the tree to start with. ``None`` to start with an
+                empty tree.
+        """
+        self.git = git
+        self.root = _TreeNode(treeish)
+        if treeish is None:
+            self.root.entries = {}
+            self.root.dirty = True
+
+    def add(self, path, obj, mode=None, typ=None):
+        """
+        Insert or replace the entry at ``path`` with ``obj``.
+
+        Args:
+            path(str): slash separated path relative to the root tree.
+
+            obj(str): hash of the object to put at ``path``.
+
+            mode(str): file mode. By default it is ``040000`` for a tree,
+                ``160000`` for a commit and ``100644`` for a blob.
+
+            typ(str): type of ``obj``. If it is ``None``, it is queried with
+                ``Git.obj_type``.
+
+        Returns:
+            self
+        """
+        if typ is None:
+            typ = self.git.obj_type(obj, flag='x')
+
+        if typ == 'tree':
+            mode = '040000'
+        elif typ == 'commit':
+            mode = '160000'
+        elif mode is None:
+            mode = '100644'
+
+        nodes, fn = self._walk(path, create=True)
+        for n in nodes:
+            n.dirty = True
+
+        parent = nodes[-1]
+        parent.entries[fn] = (mode, typ, obj)
+        parent.children.pop(fn, None)
+        return self
+
+    def remove(self, path):
+        """
+        Remove the entry at ``path``. Trees that become empty are removed too.
+        Removing an absent path does nothing.
+
+        Returns:
+            self
+        """
+        nodes, fn = self._walk(path, create=False)
+        if nodes is None or fn not in nodes[-1].entries:
+            return self
+
+        for n in nodes:
+            n.dirty = True
+
+        parent = nodes[-1]
+        del parent.entries[fn]
+        parent.children.pop(fn, None)
+        return self
+
+    def write(self):
+        """
+        Write all changed trees.
+
+        Returns:
+            str: hash of the new root tree.
+        """
+        if not self.root.dirty:
+            return self.git.tree_of(self.root.oid, flag='x')
+
+        proc = subprocess.Popen([self.git.gitpath] + self.git._args() + ['mktree', '--batch'],
+                                stdin=subprocess.PIPE,
+                                stdout=subprocess.PIPE,
+                                stderr=subprocess.PIPE,
+                                cwd=self.git.cwd)
+        try:
+            oid = self._write_node(proc, self.root)
+        except BrokenPipeError:
+            oid = None
+        finally:
+            proc.stdin.close()
+            err = proc.stderr.read()
+            proc.stdout.close()
+            proc.stderr.close()
+            code = proc.wait()
+
+        if oid is None or code != 0:
+            raise CalledProcessError(code, '', err.decode('utf-8', 'replace'), proc.args,
+                                     {'cwd': self.git.cwd})
+
+        return oid
+
+    def _write_node(self, proc, node):
+
+        for fn, child in node.children.items():
+            if not child.dirty:
+                continue
+
+            oid = self._write_node(proc, child)
+            if oid is None:
+                return None
+
+            if len(child.entries) == 0:
+                node.entries.pop(fn, None)
+            else:
+                node.entries[fn] = ('040000', 'tree', oid)
+
+        node.children = {}
+        node.dirty = False
+
+        lines = ['{} {} {}\t{}\n'.format(mode, typ, obj, fn)
+                 for fn, (mode, typ, obj) in node.entries.items()]
+
+        proc.stdin.write(to_bytes(''.join(lines)) + b'\n')
+        proc.stdin.flush()
+
+        oid = proc.stdout.readline().decode().strip()
+        if oid == '':
+            return None
+
+        node.oid = oid
+        return oid
+
+    def _walk(self, path, create):
+        """
+        Returns the trees from root to the parent of ``path`` and the last
+        path component. Returns ``(None, None)`` if the parent does not exist
+        and ``create`` is False.
+        """
+
+        elts = [_quote_path(to_bytes(x))
+                for x in path.split('/') if x != '']
+        if len(elts) == 0:
+            raise ValueError('invalid path: ' + repr(path))
+
+        node = self.root
+        self._load(node)
+        nodes = [node]
+
+        for fn in elts[:-1]:
+            child = node.children.get(fn)
+            if child is None:
+                ent = node.entries.get(fn)
+                if ent is not None and ent[1] == 'tree':
+                    child = _TreeNode(ent[2])
+                elif create:
+                    # absent or not a tree: replace it with a new tree
+                    child = _TreeNode(None)
+                    child.entries = {}
+                else:
+                    return None, None
+
+                node.children[fn] = child
+
+            node = child
+            self._load(node)
+            nodes.append(node)
+
+        return nodes, elts[-1]
+
+    def _load(self, node):
+        if node.entries is not None:
+            return
+
+        node.entries = {}
+        for line in self.git.tree_items(node.oid, flag='x'):
+            itm = self.git.treeitem_parse(line)
+            node.entries[itm['fn']] = (itm['mode'], itm['type'], itm['object'])
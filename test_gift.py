@@ -5,15 +5,22 @@
 # TODO test: commit --sub with dirty work dir
 # TODO commit --sub add history to commit log
 import imp
+import json
 import os
 import shutil
+import socket
+import subprocess
+import sys
+import tarfile
 import tempfile
+import time
 import unittest
 
 from k3fs import fread
 from k3fs import fwrite
 from k3git import GitOpt
 from k3handy import cmd0
+from k3handy import cmdf
 from k3handy import cmdout
 from k3handy import cmdtty
 from k3handy import cmdx
@@ -32,6 +39,7 @@ Gift = gift.Gift
 this_base = os.path.dirname(__file__)
 
 giftp = pjoin(this_base, "gift")
+clientp = pjoin(this_base, "gift-client")
 origit = "git"
 
 emptyp = pjoin(this_base, "testdata", "empty")
@@ -60,6 +68,7 @@ def _clean_case():
     force_remove(pjoin(this_base, "testdata", "empty", ".git"))
     force_remove(pjoin(this_base, "testdata", "super", ".git"))
     force_remove(barp)
+    force_remove(pjoin(this_base, "testdata", "superclone"))
     cmdx(origit, "reset", "testdata", cwd=this_base)
     cmdx(origit, "checkout", "testdata", cwd=this_base)
     cmdx(origit, "clean", "-dxf", cwd=this_base)
@@ -144,7 +153,195 @@ class TestGiftAPI(BaseTest):
             'refhead': 'refs/gift/sub/foo/bar',
             'sub_gitdir': 'gift/subdir/foo/bar',
             'upstream': {'branch': 'master', 'name': 'origin', 'url': '../bargit'}
-        }, sb)
+        }, {
+            'bareenv': sb.bareenv,
+            'dir': sb.dir,
+            'env': sb.env,
+            'refhead': sb.refhead,
+            'sub_gitdir': sb.sub_gitdir,
+            'upstream': sb.upstream,
+        })
+        self.assertIs(sb, gg.conf["dirs"]["foo/bar"], "SubRepo is built once")
+
+        rel, sb = gg.get_subrepo_config(pjoin(superp, "foo/bar/x/y"))
+        self.assertEqual('foo/bar', rel)
+
+    def test_subrepos(self):
+        dirs = {"a": "../a@master", "b/c": "git@github.com:x/c.git@dev"}
+        subs = gift.SubRepos(dirs, "/s/.git", "/s")
+
+        self.assertEqual(2, len(subs))
+        self.assertEqual(["a", "b/c"], sorted(subs))
+        self.assertTrue("b/c" in subs)
+        self.assertFalse("b" in subs)
+        self.assertEqual({}, subs.subs, "nothing is built by iterating")
+
+        sb = subs["b/c"]
+        self.assertEqual(["b/c"], list(subs.subs))
+        self.assertEqual({"name": "origin",
+                          "url": "git@github.com:x/c.git",
+                          "branch": "dev"}, sb.upstream)
+        self.assertEqual("refs/gift/sub/b/c", sb.refhead)
+        self.assertEqual({"GIT_DIR": "/s/.git/gift/subdir/b/c",
+                          "GIT_WORK_TREE": "/s/b/c"}, sb.env)
+        self.assertEqual({"GIT_DIR": "/s/.git/gift/subdir/b/c"}, sb.bareenv)
+
+        self.assertIsNone(subs.get("x"))
+        with self.assertRaises(KeyError):
+            subs["x"]
+
+        with self.assertRaises(AttributeError):
+            sb.foo = 1
+
+    def test_sub_owners(self):
+        gg = Gift(GitOpt().update({
+            'startpath': [superp],
+            'git_dir': None,
+            'work_tree': None,
+        }))
+
+        index = gg.build_index(["a/b", "a/b/c/d", "x", "y/"])
+        self.assertEqual({
+            "a": {"b": {"": "a/b",
+                        "c": {"d": {"": "a/b/c/d"}}}},
+            "x": {"": "x"},
+            "y": {"": "y/"},
+        }, index)
+
+        cases = (
+            ('.', []),
+            ('a', []),
+            ('a/b', ['a/b']),
+            ('a/b/c', ['a/b']),
+            ('a/b/c/d', ['a/b', 'a/b/c/d']),
+            ('a/b/c/d/e/f', ['a/b', 'a/b/c/d']),
+            ('x', ['x']),
+            ('xx', []),
+            ('y', ['y/']),
+        )
+        for rel, want in cases:
+            self.assertEqual(want, gg.sub_owners(rel, index), rel)
+
+    def test_head_state(self):
+        gg = Gift(GitOpt().update({
+            'startpath': [superp],
+            'git_dir': None,
+            'work_tree': None,
+        }))
+        gg.init_git_config()
+
+        master = "c3954c897dfe40a5b99b7145820eeb227210265c"
+        self.assertEqual(("refs/heads/master", master), gg._head_state())
+
+        cmdx(origit, "checkout", "-q", master, cwd=superp)
+        self.assertEqual((None, master), gg._head_state())
+
+        cmdx(origit, "checkout", "-q", "master", cwd=superp)
+        cmdx(origit, "pack-refs", "--all", cwd=superp)
+        self._nofile(supergitp, "refs", "heads", "master")
+        self.assertEqual(("refs/heads/master", master), gg._head_state())
+
+        cmdx(origit, "checkout", "-q", "--orphan", "unborn", cwd=superp)
+        self.assertEqual(("refs/heads/unborn", None), gg._head_state())
+        gg.close()
+
+    def test_sub_head(self):
+        cmdx(giftp, "init", "--sub", cwd=superp)
+
+        gg = Gift(GitOpt().update({
+            'startpath': [superp],
+            'git_dir': None,
+            'work_tree': None,
+        }))
+        gg.init_git_config()
+        sb = gg.conf["dirs"]["foo/bar"]
+
+        barhead = cmd0(giftp, "rev-parse", "HEAD", cwd=subbarp)
+        self.assertEqual(barhead, gg._sub_head(sb))
+
+        cmdx(giftp, "pack-refs", "--all", cwd=subbarp)
+        self.assertEqual(barhead, gg._sub_head(sb))
+        gg.close()
+
+    def test_conf_cache(self):
+        opt = {
+            'startpath': [superp],
+            'git_dir': None,
+            'work_tree': None,
+        }
+        gg = Gift(GitOpt().update(opt))
+        gg.init_git_config()
+
+        cachepath = pjoin(supergitp, "gift", "conf-cache.json")
+        self.assertTrue(os.path.isfile(cachepath))
+
+        # warm load reads from cache
+        cache = json.loads(fread(cachepath))
+        cache["conf"]["dirs"]["foo/bar"] = "from-cache@master"
+        fwrite(cachepath, json.dumps(cache))
+
+        gg = Gift(GitOpt().update(opt))
+        gg.init_git_config()
+        _, sb = gg.get_subrepo_config(pjoin(superp, "foo/bar"))
+        self.assertEqual("from-cache", sb.upstream["url"])
+
+        # changing .gift invalidates cache
+        fwrite(pjoin(superp, ".gift"), fread(pjoin(superp, ".gift")) + "\n")
+
+        gg = Gift(GitOpt().update(opt))
+        gg.init_git_config()
+        _, sb = gg.get_subrepo_config(pjoin(superp, "foo/bar"))
+        self.assertEqual("../bargit", sb.upstream["url"])
+
+        # broken cache is rebuilt
+        fwrite(cachepath, "{")
+        gg = Gift(GitOpt().update(opt))
+        gg.init_git_config()
+        _, sb = gg.get_subrepo_config(pjoin(superp, "foo/bar"))
+        self.assertEqual("../bargit", sb.upstream["url"])
+
+    def test_passthrough_ok(self):
+
+        def ok(path, cmds, **opt):
+            o = {
+                'startpath': [path],
+                'git_dir': None,
+                'work_tree': None,
+            }
+            o.update(opt)
+            return Gift(GitOpt().update(o))._passthrough_ok(cmds)
+
+        # no conf cache yet
+        self.assertFalse(ok(superp, ["log"]))
+
+        Gift(GitOpt().update({
+            'startpath': [superp],
+            'git_dir': None,
+            'work_tree': None,
+        })).init_git_config()
+
+        self.assertTrue(ok(superp, ["log", "-n1"]))
+        self.assertTrue(ok(pjoin(superp, "foo"), ["status"]))
+        self.assertFalse(ok(superp, ["checkout", "HEAD~"]), "may move HEAD")
+        self.assertFalse(ok(superp, ["fetch", "--sub"]))
+        self.assertFalse(ok(superp, ["gift-debug"]))
+        self.assertFalse(ok(superp, []))
+        self.assertFalse(ok(subbarp, ["log"]), "in sub repo")
+        self.assertFalse(ok(pjoin(subbarp, "x"), ["log"]), "in sub repo")
+        self.assertFalse(ok(superp, ["log"], git_dir=supergitp))
+
+        # .gift changed, cache is stale
+        fwrite(pjoin(superp, ".gift"), fread(pjoin(superp, ".gift")) + "\n")
+        self.assertFalse(ok(superp, ["log"]))
+
+        # no .gift
+        cmdx(giftp, "init", cwd=emptyp)
+        self.assertTrue(ok(emptyp, ["checkout", "-b", "foo"]))
+        self.assertFalse(ok(pjoin(emptyp, ".git"), ["log"]), "in git dir")
+        self.assertFalse(ok(pjoin(emptyp, ".git", "refs"), ["log"]), "in git dir")
+
+        with tempfile.TemporaryDirectory() as tmpdir:
+            self.assertTrue(ok(tmpdir, ["log"]), "not in work tree")
 
 
 class TestGiftPartialInit(BaseTest):
@@ -167,42 +364,42 @@ class TestGiftPartialInit(BaseTest):
 
     def test_init_1_with_inited(self):
 
-        cmdx(origit, "init", "--bare", self.sb['env']['GIT_DIR'])
+        cmdx(origit, "init", "--bare", self.sb.env['GIT_DIR'])
 
         cmdx(giftp, "init", "--sub", cwd=superp)
         self._fcontent("bar\n", subbarp, "bar")
 
     def test_init_2_with_remote(self):
 
-        cmdx(origit, "init", "--bare", self.sb['env']['GIT_DIR'])
-        cmdx(origit, "remote", "add", self.sb['upstream']['name'],
-             self.sb['upstream']['url'], env=self.sb['bareenv'])
+        cmdx(origit, "init", "--bare", self.sb.env['GIT_DIR'])
+        cmdx(origit, "remote", "add", self.sb.upstream['name'],
+             self.sb.upstream['url'], env=self.sb.bareenv)
 
         cmdx(giftp, "init", "--sub", cwd=superp)
         self._fcontent("bar\n", subbarp, "bar")
 
     def test_init_3_with_fetched(self):
 
-        cmdx(origit, "init", "--bare", self.sb['env']['GIT_DIR'])
-        cmdx(origit, "remote", "add", self.sb['upstream']['name'],
-             self.sb['upstream']['url'], env=self.sb['bareenv'])
-        cmdx(origit, "fetch", self.sb['upstream']
-             ['name'], env=self.sb['bareenv'], cwd=superp)
+        cmdx(origit, "init", "--bare", self.sb.env['GIT_DIR'])
+        cmdx(origit, "remote", "add", self.sb.upstream['name'],
+             self.sb.upstream['url'], env=self.sb.bareenv)
+        cmdx(origit, "fetch", self.sb.upstream
+             ['name'], env=self.sb.bareenv, cwd=superp)
 
         cmdx(giftp, "init", "--sub", cwd=superp)
         self._fcontent("bar\n", subbarp, "bar")
 
     def test_init_4_already_checkout(self):
 
-        cmdx(origit, "init", "--bare", self.sb['env']['GIT_DIR'])
-        cmdx(origit, "remote", "add", self.sb['upstream']['name'],
-             self.sb['upstream']['url'], env=self.sb['bareenv'])
-        cmdx(origit, "fetch", self.sb['upstream']
-             ['name'], env=self.sb['bareenv'], cwd=superp)
+        cmdx(origit, "init", "--bare", self.sb.env['GIT_DIR'])
+        cmdx(origit, "remote", "add", self.sb.upstream['name'],
+             self.sb.upstream['url'], env=self.sb.bareenv)
+        cmdx(origit, "fetch", self.sb.upstream
+             ['name'], env=self.sb.bareenv, cwd=superp)
 
-        os.makedirs(self.sb['env']['GIT_WORK_TREE'], mode=0o755)
+        os.makedirs(self.sb.env['GIT_WORK_TREE'], mode=0o755)
         cmdx(origit, "checkout",
-             self.sb['upstream']['branch'], env=self.sb['env'])
+             self.sb.upstream['branch'], env=self.sb.env)
         self._fcontent("bar\n", subbarp, "bar")
 
         os.unlink(pjoin(subbarp, "bar"))
@@ -515,6 +712,63 @@ class TestGift(BaseTest):
             self._gitoutput([giftp, "ls-files"],
                             [".gift", "imsuperman"], cwd=superp)
 
+    def test_init_sub_marker(self):
+        cmdx(giftp, "init", "--sub", cwd=superp)
+
+        marker = pjoin(supergitp, "gift", "subdir", "foo", "bar", "gift", "init.json")
+        self.assertEqual({"url": "../bargit", "branch": "master"},
+                         {k: v for k, v in json.loads(fread(marker)).items()
+                          if k in ("url", "branch")})
+
+        gg = Gift(GitOpt().update({
+            'startpath': [superp],
+            'git_dir': None,
+            'work_tree': None,
+        }))
+        gg.init_git_config()
+        sb = gg.conf["dirs"]["foo/bar"]
+
+        called = []
+        gg.try_init_sub_git = lambda sb, buf: called.append("git")
+        gg.try_init_sub_worktree = lambda sb, buf: called.append("worktree")
+
+        gg.check_worktree(sb)
+        self.assertEqual([], called, "marker matches, no check")
+
+        # super config changed
+        cmdx(origit, "config", "gift.foo", "bar", cwd=superp)
+        gg.check_worktree(sb)
+        self.assertEqual(["git", "worktree"], called)
+
+        gg.check_worktree(sb)
+        self.assertEqual(["git", "worktree"], called, "marker is updated")
+
+        # work tree removed
+        shutil.rmtree(subbarp)
+        self.assertIsNone(gg._init_state(sb))
+        gg.check_worktree(sb)
+        self.assertEqual(["git", "worktree"] * 2, called)
+
+        # the full check recreates work tree dir and the marker
+        mtime = os.stat(marker).st_mtime_ns
+        cmdx(giftp, "init", "--sub", cwd=superp)
+        self.assertTrue(os.path.isdir(subbarp))
+        self.assertEqual(gg._init_state(sb), json.loads(fread(marker)))
+        self.assertNotEqual(mtime, os.stat(marker).st_mtime_ns)
+
+    def test_init_sub_jobs(self):
+        cmdx(giftp, "init", "--sub", "-j", "2", cwd=superp)
+
+        self._fcontent("bar\n", subbarp, "bar")
+        self._fcontent("wow\n", subwowp, "wow")
+
+        cmdx(giftp, *ident_args, "commit", "--sub", cwd=superp)
+        self._remove_super_ref()
+
+        # super/head is populated after all subs are setup
+        cmdx(giftp, "init", "--sub", "--jobs=2", cwd=superp)
+        self._check_initial_superhead()
+
     def test_commit_in_super(self):
         cmdx(giftp, "init", "--sub", cwd=superp)
         cmdx(giftp, "add", "foo", cwd=superp)
@@ -554,6 +808,101 @@ class TestGift(BaseTest):
             superp, ".gift-refs",
         )
 
+    def test_commit_sub_refhead(self):
+        cmdx(giftp, "init", "--sub", cwd=superp)
+        cmdx(giftp, *ident_args, "commit", "--sub", cwd=superp)
+
+        self._add_file_to_subbar()
+        cmdx(giftp, *ident_args, "commit", "--sub", cwd=superp)
+
+        barhead = cmd0(giftp, "rev-parse", "HEAD", cwd=subbarp)
+        self.assertEqual(barhead,
+                         cmd0(origit, "rev-parse", "refs/gift/sub/foo/bar", cwd=superp))
+        self.assertEqual("6bf37e52cbafcf55ff4710bb2b63309b55bf8e54",
+                         cmd0(origit, "rev-parse", "refs/gift/sub/foo/wow", cwd=superp))
+
+        self._gitoutput([giftp, "ls-files"],
+                        [
+            ".gift",
+            ".gift-refs",
+            "foo/bar/bar",
+            "foo/bar/newbar",
+            "foo/wow/wow",
+            "imsuperman",
+        ],
+            cwd=superp)
+
+        # .gift-refs in work tree is the same as the committed one.
+        self._gitoutput([giftp, "status", "--porcelain", ".gift-refs"], [], cwd=superp)
+
+    def test_commit_sub_skip_unchanged(self):
+        cmdx(giftp, "init", "--sub", cwd=superp)
+        _, _, err = cmdx(giftp, *ident_args, "commit", "--sub", cwd=superp)
+        self.assertNotIn("GIFT: skipped 1 unchanged sub repo(s)", err)
+
+        self._add_file_to_subbar()
+        _, _, err = cmdx(giftp, *ident_args, "commit", "--sub", cwd=superp)
+        self.assertIn("GIFT: skipped 1 unchanged sub repo(s)", err)
+
+        self._gitoutput([giftp, "ls-files"],
+                        [
+            ".gift",
+            ".gift-refs",
+            "foo/bar/bar",
+            "foo/bar/newbar",
+            "foo/wow/wow",
+            "imsuperman",
+        ],
+            cwd=superp)
+
+        barhead = cmd0(giftp, "rev-parse", "HEAD", cwd=subbarp)
+        self._fcontent(
+            "\n".join(["- - foo/bar",
+                       "  - " + barhead,
+                       "- - foo/wow",
+                       "  - 6bf37e52cbafcf55ff4710bb2b63309b55bf8e54",
+                       ""]),
+            superp, ".gift-refs",
+        )
+
+        # a sub tree removed from super tree is not skipped
+        cmdx(giftp, "rm", "-r", "--cached", "foo/wow", cwd=superp)
+        cmdx(giftp, *ident_args, "commit", "-m", "rm wow", cwd=superp)
+        _, _, err = cmdx(giftp, *ident_args, "commit", "--sub", cwd=superp)
+        self.assertIn("GIFT: skipped 1 unchanged sub repo(s)", err)
+        self._gitoutput([giftp, "ls-files", "foo"],
+                        ["foo/bar/bar", "foo/bar/newbar", "foo/wow/wow"],
+                        cwd=superp)
+
+    def test_commit_sub_shared_objects(self):
+        cmdx(giftp, "config", "gift.sharedObjects", "true", cwd=superp)
+        cmdx(giftp, "init", "--sub", "-j", "2", cwd=superp)
+
+        self._fcontent("../gift/subdir/foo/bar/objects\n../gift/subdir/foo/wow/objects\n",
+                       supergitp, "objects", "info", "alternates")
+
+        self._gitoutput([giftp, "config", "gc.pruneExpire"], ["never"], cwd=subbarp)
+
+        cmdx(giftp, *ident_args, "commit", "--sub", cwd=superp)
+        self._check_initial_superhead()
+
+        # sub commits are not copied into super repo
+        self._nofile(supergitp, "objects", "46", "6f0bbdf56b1428edf2aed4f6a99c1bd1d4c8af")
+        self._nofile(supergitp, "objects", "6b", "f37e52cbafcf55ff4710bb2b63309b55bf8e54")
+
+        self._gitoutput([giftp, "ls-files"],
+                        [
+            ".gift",
+            ".gift-refs",
+            "foo/bar/bar",
+            "foo/wow/wow",
+            "imsuperman",
+        ],
+            cwd=superp)
+
+        self.assertEqual("466f0bbdf56b1428edf2aed4f6a99c1bd1d4c8af",
+                         cmd0(origit, "rev-parse", "refs/gift/sub/foo/bar", cwd=superp))
+
     def test_fetch_sub(self):
 
         cmdx(giftp, "init", "--sub", cwd=superp)
@@ -568,6 +917,488 @@ class TestGift(BaseTest):
 
         self.assertEqual(headhash, fetched_hash)
 
+    def test_fetch_sub_narrow(self):
+
+        cmdx(giftp, "init", "--sub", cwd=superp)
+
+        headhash = self._add_commit_to_bar_from_other_clone()
+        cmdx(origit, "push", "origin", "master:other", cwd=barp)
+        cmdx(origit, "tag", "v1", cwd=barp)
+        cmdx(origit, "push", "origin", "v1", cwd=barp)
+
+        refs = [giftp, "for-each-ref", "--format=%(refname)", "refs/remotes", "refs/tags"]
+
+        # only the branch in .gift
+        cmdx(giftp, "fetch", "--sub", cwd=superp)
+        self._gitoutput(refs, ["refs/remotes/origin/master"], cwd=subbarp)
+        self.assertEqual(headhash, cmd0(giftp, "rev-parse", "origin/master", cwd=subbarp))
+
+        cmdx(giftp, "config", "gift.fetchAll", "true", cwd=superp)
+        cmdx(giftp, "fetch", "--sub", cwd=superp)
+        self._gitoutput(refs, ["refs/remotes/origin/master",
+                               "refs/remotes/origin/other",
+                               "refs/tags/v1"], cwd=subbarp)
+
+    def test_status_sub(self):
+
+        cmdx(giftp, "init", "--sub", cwd=superp)
+        cmdx(giftp, *ident_args, "commit", "--sub", cwd=superp)
+
+        header = "SUB      WORKTREE  UPSTREAM       AHEAD  BEHIND  PIN"
+        self._gitoutput([giftp, "status", "--sub"], [
+            header,
+            "foo/bar  clean     origin/master  0      0       same",
+            "foo/wow  clean     origin/master  0      0       same",
+        ], cwd=superp)
+
+        self._add_file_to_subbar()
+        self._add_commit_to_bar_from_other_clone()
+        cmdx(giftp, "fetch", "--sub", cwd=superp)
+
+        fwrite(pjoin(subwowp, "wow"), "changed")
+        # untracked file does not make a sub dirty
+        fwrite(pjoin(subbarp, "untracked"), "untracked")
+
+        self._gitoutput([giftp, "status", "--sub", "-j", "1"], [
+            header,
+            "foo/bar  clean     origin/master  1      1       moved",
+            "foo/wow  dirty     origin/master  0      0       same",
+        ], cwd=subbarp)
+
+    def test_log_sub(self):
+
+        cmdx(giftp, "init", "--sub", cwd=superp)
+
+        # commits interleaved by date
+        for subp, fn, ts in ((subbarp, "b1", 2000000001),
+                             (subwowp, "w1", 2000000002),
+                             (subbarp, "b2", 2000000003)):
+            fwrite(pjoin(subp, fn), fn)
+            cmdx(giftp, "add", fn, cwd=subp)
+            date = "@{} +0000".format(ts)
+            cmdx(giftp, *ident_args, "commit", "-m", fn, cwd=subp,
+                 env={"GIT_COMMITTER_DATE": date, "GIT_AUTHOR_DATE": date})
+
+        self._gitoutput([giftp, "log", "--sub", "-n", "3", "--format=%s"], [
+            "foo/bar: b2",
+            "foo/wow: w1",
+            "foo/bar: b1",
+        ], cwd=superp)
+
+        self._gitoutput([giftp, "log", "--sub", "-2", "--format=%s%n%ad", "--date=unix"], [
+            "foo/bar: b2",
+            "foo/bar: 2000000003",
+            "foo/wow: w1",
+            "foo/wow: 2000000002",
+        ], cwd=superp)
+
+        # paths are relative to cwd
+        self._gitoutput([giftp, "log", "--sub", "--since=@2000000000", "--oneline", "--format=%s",
+                         "--", "bar/b1", "wow"], [
+            "foo/wow: w1",
+            "foo/bar: b1",
+        ], cwd=pjoin(superp, "foo"))
+
+    def test_grep_sub(self):
+
+        cmdx(giftp, "init", "--sub", cwd=superp)
+        cmdx(giftp, *ident_args, "commit", "--sub", cwd=superp)
+
+        self._gitoutput([giftp, "grep", "--sub", "-n", "ba"], [
+            "foo/bar/bar:1:bar",
+        ], cwd=superp)
+
+        self._gitoutput([giftp, "grep", "--sub", "-l", "-e", "bar", "-e", "wow"], [
+            "foo/bar/bar",
+            "foo/wow/wow",
+        ], cwd=superp)
+
+        # paths relative to cwd, searching only in cwd
+        self._gitoutput([giftp, "grep", "--sub", "-l", "-e", "bar", "-e", "wow"], [
+            "bar",
+        ], cwd=subbarp)
+        self._gitoutput([giftp, "grep", "--sub", "-c", "-e", "bar", "-e", "wow", "--", "../wow"], [
+            "../wow/wow:1",
+        ], cwd=subbarp)
+
+        # search the pinned commit
+        fwrite(pjoin(subbarp, "bar"), "changed")
+        code, out, _ = cmdf(giftp, "grep", "--sub", "-w", "bar", cwd=superp)
+        self.assertEqual((1, []), (code, out))
+        self._gitoutput([giftp, "grep", "--sub", "--pinned", "-w", "bar"], [
+            "refs/remotes/super/head:foo/bar/bar:bar",
+        ], cwd=superp)
+
+        code, _, _ = cmdf(giftp, "grep", "--sub", "nothing-matches", cwd=superp)
+        self.assertEqual(1, code)
+
+    def test_foreach_sub(self):
+
+        cmdx(giftp, "init", "--sub", cwd=superp)
+
+        _, out, err = cmdx(giftp, "foreach", "--sub", "-j", "2", "--",
+                           "git", "rev-parse", "--show-toplevel", cwd=superp)
+        self.assertEqual([subbarp, subwowp], sorted(out))
+        self.assertIn("GIFT: foreach: 2 succeeded, 0 failed, 0 skipped in", err[-2])
+
+        # a single command is a shell script
+        _, out, _ = cmdx(giftp, "foreach", "--sub", "--", 'echo "$GIFT_SUB_DIR" && git ls-files',
+                         cwd=superp)
+        self.assertEqual(["bar", "foo/bar", "foo/wow", "wow"], sorted(out))
+
+        # fail fast: with 1 job, the second sub is not run
+        code, out, err = cmdf(giftp, "foreach", "--sub", "--", "echo ran; exit 3", cwd=superp)
+        self.assertEqual(1, code)
+        self.assertEqual(["ran"], out)
+        self.assertIn("GIFT: foreach: 0 succeeded, 1 failed, 1 skipped in", "\n".join(err))
+
+        code, out, err = cmdf(giftp, "foreach", "--sub", "--keep-going", "--", "echo ran; exit 3",
+                              cwd=superp)
+        self.assertEqual(2, code)
+        self.assertEqual(["ran", "ran"], out)
+
+    def test_archive_sub(self):
+
+        cmdx(giftp, "init", "--sub", cwd=superp)
+        cmdx(giftp, *ident_args, "commit", "--sub", cwd=superp)
+
+        # a super commit whose tree lacks foo/bar, but pins it in .gift-refs
+        env = {"GIT_INDEX_FILE": pjoin(superp, "tmpindex")}
+        cmdx(origit, "read-tree", "HEAD", cwd=superp, env=env)
+        cmdx(origit, "rm", "-r", "-q", "--cached", "foo/bar", cwd=superp, env=env)
+        tree = cmd0(origit, "write-tree", cwd=superp, env=env)
+        os.unlink(pjoin(superp, "tmpindex"))
+        commit = cmd0(origit, *ident_args, "commit-tree", "-p", "HEAD", "-m", "no bar", tree, cwd=superp)
+
+        # no sub work tree is needed
+        shutil.rmtree(subbarp)
+
+        tarpath = pjoin(this_base, "testdata", "a.tar")
+        cmdx(giftp, "archive", "--sub", "--prefix=x/", "-o", tarpath, commit, cwd=superp)
+
+        with tarfile.open(tarpath) as tf:
+            names = tf.getnames()
+            self.assertIn("x/.gift", names)
+            self.assertIn("x/foo/wow/wow", names)
+            self.assertEqual(b"bar\n", tf.extractfile("x/foo/bar/bar").read())
+
+            ct = int(cmd0(origit, "log", "-1", "--format=%ct", commit, cwd=superp))
+            self.assertEqual(ct, tf.getmember("x/foo/bar/bar").mtime)
+
+        # paths and the default HEAD
+        cmdx(giftp, "archive", "--sub", "-o", tarpath, "--", "foo/bar", cwd=superp)
+        with tarfile.open(tarpath) as tf:
+            self.assertEqual(["foo", "foo/bar", "foo/bar/bar"], sorted(tf.getnames()))
+
+        # option values are not taken as tree-ish
+        cmdx(giftp, "archive", "--sub", "--format", "tar", "--prefix", "y/",
+             "--output", tarpath, "--", "foo/bar", cwd=superp)
+        with tarfile.open(tarpath) as tf:
+            self.assertEqual(["y", "y/foo", "y/foo/bar", "y/foo/bar/bar"], sorted(tf.getnames()))
+
+    def test_archive_sub_in_clone(self):
+
+        cmdx(giftp, "init", "--sub", cwd=superp)
+        cmdx(giftp, *ident_args, "commit", "--sub", cwd=superp)
+
+        # refs/gift/sub/* are not cloned. Relative sub urls work at the same
+        # level as super.
+        clonep = pjoin(this_base, "testdata", "superclone")
+        cmdx(origit, "clone", "--no-local", "-q", supergitp, clonep)
+
+        # the sub trees in super tree are used
+        tarpath = pjoin(this_base, "testdata", "a.tar")
+        cmdx(giftp, "archive", "--sub", "-o", tarpath, cwd=clonep)
+        with tarfile.open(tarpath) as tf:
+            self.assertEqual(b"bar\n", tf.extractfile("foo/bar/bar").read())
+            self.assertEqual(b"wow\n", tf.extractfile("foo/wow/wow").read())
+
+        # a super commit whose tree lacks foo/bar
+        cmdx(origit, "rm", "-r", "-q", "--cached", "foo/bar", cwd=clonep)
+        cmdx(origit, *ident_args, "commit", "-q", "-m", "no bar", cwd=clonep)
+
+        code, out, err = cmdf(giftp, "archive", "--sub", "-o", tarpath, cwd=clonep)
+        self.assertEqual(2, code)
+        self.assertIn("try: git fetch --sub", "\n".join(err))
+
+        # imported from sub gitdir, without updating refs/gift/sub/foo/bar.
+        # .gift in super work tree differs from the committed one.
+        shutil.copy(pjoin(superp, ".gift"), pjoin(clonep, ".gift"))
+        cmdx(giftp, "init", "--sub", cwd=clonep)
+        cmdx(giftp, "archive", "--sub", "-o", tarpath, cwd=clonep)
+        with tarfile.open(tarpath) as tf:
+            self.assertEqual(b"bar\n", tf.extractfile("foo/bar/bar").read())
+
+        code, out, err = cmdf(origit, "rev-parse", "--verify", "-q", "refs/gift/sub/foo/bar", cwd=clonep)
+        self.assertEqual(1, code)
+
+    def test_commit_sub_upstream(self):
+
+        self.assertFalse(os.path.exists(subbarp))
+
+        # without sub work tree
+        cmdx(giftp, *ident_args, "commit", "--sub", "--upstream", cwd=superp)
+
+        self.assertFalse(os.path.exists(subbarp))
+        self.assertFalse(os.path.exists(subwowp))
+
+        barmaster = cmd0(origit, "rev-parse", "master", cwd=bargitp)
+        wowmaster = cmd0(origit, "rev-parse", "master", cwd=pjoin(this_base, "testdata", "wowgit"))
+        self._gitoutput([origit, "show", "HEAD:.gift-refs"], [
+            "- - foo/bar",
+            "  - " + barmaster,
+            "- - foo/wow",
+            "  - " + wowmaster,
+        ], cwd=superp)
+        self._gitoutput([origit, "rev-parse", "HEAD:foo/bar"],
+                        [cmd0(origit, "rev-parse", "master^{tree}", cwd=bargitp)], cwd=superp)
+
+        # bump pins to the fetched upstream
+        headhash = self._add_commit_to_bar_from_other_clone()
+        cmdx(giftp, "fetch", "--sub", "--no-checkout", cwd=superp)
+        cmdx(giftp, *ident_args, "commit", "--sub", "--upstream", cwd=superp)
+
+        self._gitoutput([origit, "rev-parse", "refs/gift/sub/foo/bar"], [headhash], cwd=superp)
+        self._gitoutput([origit, "show", "HEAD:foo/bar/for_fetch"], ["for_fetch"], cwd=superp)
+
+        self._gitoutput([giftp, "status", "--sub"], [
+            "SUB      WORKTREE     UPSTREAM       AHEAD  BEHIND  PIN",
+            "foo/bar  no-worktree  origin/master  0      0       same",
+            "foo/wow  no-worktree  origin/master  0      0       same",
+        ], cwd=superp)
+        self._gitoutput([origit, "--git-dir=" + pjoin(supergitp, "gift", "subdir", "foo", "bar"),
+                         "rev-parse", "super/head"], [headhash], cwd=superp)
+        self.assertFalse(os.path.exists(subwowp))
+
+    def test_nested_sub_jobs(self):
+
+        fwrite(pjoin(superp, ".gift"), "\n".join([
+            "dirs:",
+            "    foo/bar: ../bargit@master",
+            "    foo/bar/inner: ../wowgit@master",
+            "    foo/wow: ../wowgit@master",
+            "",
+        ]))
+
+        gg = Gift(GitOpt().update({'startpath': [superp], 'git_dir': None, 'work_tree': None}))
+        gg.init_git_config()
+        dirs = gg.conf["dirs"]
+        self.assertEqual([["foo/bar", "foo/bar/inner"], ["foo/wow"]],
+                         [[sb.dir for sb in g]
+                          for g in gg._nest_groups([[dirs["foo/bar/inner"]], [dirs["foo/wow"]], [dirs["foo/bar"]]])])
+        self.assertEqual([["foo/bar", "foo/bar/inner", "foo/wow"]],
+                         [[sb.dir for sb in g] for g in gg._fetcher()[0]],
+                         "nested subs and subs of one upstream")
+        gg.close()
+
+        # gitdir of foo/bar is created by the nested one
+        os.makedirs(pjoin(supergitp, "gift", "subdir", "foo", "bar", "inner"))
+
+        cmdx(giftp, "init", "--sub", "-j", "2", cwd=superp)
+        self._fcontent("bar\n", subbarp, "bar")
+        self._fcontent("wow\n", subbarp, "inner", "wow")
+        self._gitoutput([giftp, "rev-parse", "--show-toplevel"], [subbarp], cwd=subbarp)
+
+    def test_sub_error(self):
+
+        # a file in place of the sub work tree
+        os.makedirs(pjoin(superp, "foo"))
+        fwrite(subwowp, "not a dir")
+
+        code, out, err = cmdf(giftp, "init", "--sub", "-j", "2", cwd=superp)
+        self.assertEqual(1, code)
+        self.assertIn("GIFT: foo/wow: FileExistsError", "\n".join(err))
+        self.assertIn("GIFT: foo/wow: failed with exit code: 1", err)
+        self.assertIn("GIFT: init failed in 1 sub repo(s)", err)
+
+        # other subs are done
+        self._fcontent("bar\n", subbarp, "bar")
+
+        code, out, err = cmdf(giftp, "pull", "--sub", cwd=superp)
+        self.assertEqual(1, code)
+        self.assertIn("GIFT: foo/wow: failed with exit code: 1", err)
+        self.assertIn("GIFT: pull failed in 1 sub repo(s)", err)
+
+    def test_fetch_sub_dedup(self):
+
+        cmdx(origit, "branch", "other", "master", cwd=bargitp)
+
+        fwrite(pjoin(superp, ".gift"), "\n".join([
+            "dirs:",
+            "    foo/bar: ../bargit@master",
+            "    foo/bar2: ../bargit@other",
+            "    foo/wow: ../wowgit@master",
+            "",
+        ]))
+        cmdx(giftp, "init", "--sub", cwd=superp)
+
+        headhash = self._add_commit_to_bar_from_other_clone()
+        cmdx(origit, "push", "origin", "master:other", cwd=barp)
+
+        cmdx(giftp, "fetch", "--sub", cwd=superp)
+
+        subbar2p = pjoin(superp, "foo", "bar2")
+        self._gitoutput([giftp, "rev-parse", "origin/master"], [headhash], cwd=subbarp)
+        self._gitoutput([giftp, "rev-parse", "origin/other"], [headhash], cwd=subbar2p)
+        self._gitoutput([giftp, "for-each-ref", "--format=%(refname)", "refs/remotes"],
+                        ["refs/remotes/origin/other"], cwd=subbar2p)
+
+        # foo/bar2 fetched from foo/bar, not from upstream
+        sub2gitdir = cmd0(giftp, "rev-parse", "--absolute-git-dir", cwd=subbar2p)
+        subgitdir = cmd0(giftp, "rev-parse", "--absolute-git-dir", cwd=subbarp)
+        reflog = cmd0(giftp, "reflog", "-1", "--format=%gs", "origin/other", cwd=subbar2p)
+        self.assertIn(os.path.normpath(subgitdir), reflog)
+        self.assertNotIn(sub2gitdir, reflog)
+
+        # fetch all
+        cmdx(giftp, "config", "gift.fetchAll", "true", cwd=superp)
+        cmdx(origit, "push", "origin", "master:third", cwd=barp)
+        cmdx(giftp, "fetch", "--sub", cwd=superp)
+        self._gitoutput([giftp, "rev-parse", "origin/third"], [headhash], cwd=subbar2p)
+
+    def test_sub_depth_filter(self):
+
+        headhash = self._add_commit_to_bar_from_other_clone()
+        cmdx(origit, "config", "uploadpack.allowFilter", "true", cwd=bargitp)
+
+        fwrite(pjoin(superp, ".gift"), "\n".join([
+            "dirs:",
+            "    foo/bar:",
+            # missing blobs are fetched from sub work tree, a relative url
+            # does not work.
+            "        remote: " + bargitp + "@master",
+            "        depth: 1",
+            "        filter: blob:none",
+            "    foo/wow: ../wowgit@master",
+            "",
+        ]))
+
+        cmdx(giftp, "init", "--sub", cwd=superp)
+
+        self._fcontent("bar\n", subbarp, "bar")
+        self._fcontent("for_fetch", subbarp, "for_fetch")
+        self._gitoutput([giftp, "rev-parse", "--is-shallow-repository"], ["true"], cwd=subbarp)
+        self._gitoutput([giftp, "rev-list", "--count", "HEAD"], ["1"], cwd=subbarp)
+        self._gitoutput([giftp, "config", "remote.origin.partialclonefilter"], ["blob:none"], cwd=subbarp)
+        self._gitoutput([giftp, "rev-parse", "--is-shallow-repository"], ["false"], cwd=subwowp)
+
+        cmdx(giftp, "fetch", "--sub", cwd=superp)
+        self._gitoutput([giftp, "rev-parse", "origin/master"], [headhash], cwd=subbarp)
+
+        # super repo takes only the tip of the reduced sub
+        self._add_file_to_subbar()
+        cmdx(giftp, *ident_args, "commit", "--sub", cwd=superp)
+
+        barhead = cmd0(giftp, "rev-parse", "HEAD", cwd=subbarp)
+        self._gitoutput([origit, "rev-parse", "refs/gift/sub/foo/bar"], [barhead], cwd=superp)
+        self._gitoutput([origit, "rev-parse", "HEAD:foo/bar"],
+                        [cmd0(giftp, "rev-parse", "HEAD^{tree}", cwd=subbarp)], cwd=superp)
+
+        # the tip is a shallow commit in super repo too
+        self._gitoutput([origit, "rev-parse", "--is-shallow-repository"], ["true"], cwd=superp)
+        self._fcontent(barhead + "\n", supergitp, "shallow")
+
+    def test_cache(self):
+
+        barhash = "466f0bbdf56b1428edf2aed4f6a99c1bd1d4c8af"
+
+        with tempfile.TemporaryDirectory() as cachedir:
+
+            # a local path is not cached, disguise bargit as a remote url.
+            env = {
+                "GIT_CONFIG_COUNT": "2",
+                "GIT_CONFIG_KEY_0": "url." + pjoin(this_base, "testdata") + "/.insteadOf",
+                "GIT_CONFIG_VALUE_0": "https://example.com/t/",
+                "GIT_CONFIG_KEY_1": "gift.cacheDir",
+                "GIT_CONFIG_VALUE_1": cachedir,
+            }
+            fwrite(pjoin(superp, ".gift"), "\n".join([
+                "dirs:",
+                "    foo/bar: https://example.com/t/bargit@master",
+                "    foo/wow: ../wowgit@master",
+                "",
+            ]))
+
+            cmdx(giftp, "init", "--sub", cwd=superp, env=env)
+            self._fcontent("bar\n", subbarp, "bar")
+            self._fcontent("wow\n", subwowp, "wow")
+
+            repo = pjoin(cachedir, "example.com", "t", "bargit.git")
+            bargitdir = pjoin(supergitp, "gift", "subdir", "foo", "bar")
+            wowgitdir = pjoin(supergitp, "gift", "subdir", "foo", "wow")
+
+            self._gitoutput([origit, "--git-dir=" + repo, "rev-parse", "master"], [barhash])
+            self._fcontent(pjoin(repo, "objects") + "\n", bargitdir, "objects", "info", "alternates")
+            self._fcontent(bargitdir + "\n", repo, "gift", "borrowers")
+            self._nofile(wowgitdir, "objects", "info", "alternates")
+
+            # all objects are borrowed
+            _, out, _ = cmdx(origit, "--git-dir=" + bargitdir, "count-objects", "-v")
+            self.assertIn("count: 0", out)
+            self.assertIn("in-pack: 0", out)
+
+            # fetch --sub updates cache first
+            headhash = self._add_commit_to_bar_from_other_clone()
+            cmdx(giftp, "fetch", "--sub", cwd=superp, env=env)
+            self._gitoutput([origit, "--git-dir=" + repo, "rev-parse", "master"], [headhash])
+            self._gitoutput([giftp, "rev-parse", "origin/master"], [headhash], cwd=subbarp)
+
+            code, out, err = cmdx(giftp, "cache", "gc", cwd=superp, env=env)
+            self.assertEqual(["GIFT: cache gc: example.com/t/bargit.git borrowed by 1"], err)
+            self._gitoutput([giftp, "cat-file", "-t", headhash], ["commit"], cwd=subbarp)
+
+            # no one borrows it, it is kept unless --prune-unused
+            shutil.rmtree(bargitdir)
+            code, out, err = cmdx(giftp, "cache", "gc", cwd=superp, env=env)
+            self.assertEqual(["GIFT: cache unused: example.com/t/bargit.git",
+                              "GIFT: cache gc: example.com/t/bargit.git borrowed by 0"], err)
+            self.assertTrue(os.path.exists(repo))
+
+            code, out, err = cmdx(giftp, "cache", "gc", "--prune-unused", cwd=superp, env=env)
+            self.assertEqual(["GIFT: cache removed: example.com/t/bargit.git"], err)
+            self.assertFalse(os.path.exists(repo))
+
+    def test_fetch_sub_jobs(self):
+
+        cmdx(giftp, "init", "--sub", cwd=superp)
+
+        headhash = self._add_commit_to_bar_from_other_clone()
+
+        for args in (["-j", "2"], ["-j2"], ["--jobs=2"], ["--jobs", "2"]):
+            cmdx(giftp, "fetch", "--sub", *args, cwd=superp)
+
+        cmdx(giftp, "config", "gift.fetch.jobs", "2", cwd=superp)
+        cmdx(giftp, "fetch", "--sub", cwd=superp)
+
+        fetched_hash = cmd0(giftp, "rev-parse", "origin/master", cwd=subbarp)
+        self.assertEqual(headhash, fetched_hash)
+
+        try:
+            cmdx(giftp, "fetch", "--sub", "-j", "0", cwd=superp)
+            self.fail("invalid jobs should fail")
+        except CalledProcessError as e:
+            self.assertEqual(2, e.returncode)
+
+    def test_fetch_sub_failure(self):
+
+        cmdx(giftp, "init", "--sub", cwd=superp)
+
+        headhash = self._add_commit_to_bar_from_other_clone()
+
+        cmdx(giftp, "remote", "set-url", "origin", "/inexistent", cwd=subwowp)
+
+        try:
+            cmdx(giftp, "fetch", "--sub", "-j", "2", cwd=superp)
+            self.fail("fetch should fail")
+        except CalledProcessError as e:
+            self.assertEqual(1, e.returncode)
+            self.assertIn("GIFT: foo/wow: failed with exit code: 128", e.err)
+            self.assertIn("GIFT: fetch failed in 1 sub repo(s)", e.err)
+
+        # other sub repos are still fetched
+        fetched_hash = cmd0(giftp, "rev-parse", "origin/master", cwd=subbarp)
+        self.assertEqual(headhash, fetched_hash)
+
     def test_merge_sub(self):
 
         cmdx(giftp, "init", "--sub", cwd=superp)
@@ -584,6 +1415,31 @@ class TestGift(BaseTest):
         self.assertEqual(headhash, fetched_hash,
                          "HEAD is updated to latest master")
 
+    def test_pull_sub(self):
+
+        cmdx(giftp, "init", "--sub", cwd=superp)
+
+        headhash = self._add_commit_to_bar_from_other_clone()
+
+        _, _, err = cmdx(giftp, "pull", "--sub", "-j", "2", cwd=superp)
+        self._gitoutput([giftp, "rev-parse", "HEAD"], [headhash], cwd=subbarp)
+
+        # reported in .gift order
+        dirs = [line.split(":")[1].strip() for line in err if line.startswith("GIFT: ")]
+        self.assertEqual(["foo/bar", "foo/bar", "foo/wow", "foo/wow"], dirs)
+
+        # a sub failed to fetch is not merged, and does not stop others
+        cmdx(giftp, "remote", "set-url", "origin", "/nonexistent", cwd=subwowp)
+        fwrite(pjoin(barp, "for_pull"), "for_pull")
+        cmdx(origit, "add", "for_pull", cwd=barp)
+        cmdx(origit, *ident_args, "commit", "-m", "add for_pull", cwd=barp)
+        cmdx(origit, "push", "origin", "master", cwd=barp)
+
+        code, _, err = cmdf(giftp, "pull", "--sub", cwd=superp)
+        self.assertEqual(1, code)
+        self.assertIn("GIFT: pull failed in 1 sub repo(s)", err)
+        self._fcontent("for_pull", subbarp, "for_pull")
+
     def test_reset_sub(self):
 
         cmdx(giftp, "init", "--sub", cwd=superp)
@@ -681,7 +1537,7 @@ class TestGift(BaseTest):
         cmdx(giftp, "reset", "HEAD~", cwd=superp)
         head2 = cmdx(giftp, "rev-parse",
                      "refs/remotes/super/head", cwd=subbarp)
-        self.assertNotEqual(head_of_bar, head2)
+        self.assertEqual(head_of_bar, head2)
 
     def test_super_checkout_should_populate_super_ref(self):
 
@@ -702,7 +1558,112 @@ class TestGift(BaseTest):
         head_of_bar_after_checkout = cmdx(
             giftp, "rev-parse", "refs/remotes/super/head", cwd=subbarp)
 
-        self.assertNotEqual(head_of_bar, head_of_bar_after_checkout)
+        self.assertEqual(head_of_bar, head_of_bar_after_checkout)
+
+
+class TestGiftDaemon(BaseTest):
+
+    @unittest.skipUnless(hasattr(socket, 'send_fds'), "daemon requires python 3.9")
+    def test_daemon(self):
+        cmdx(giftp, "init", "--sub", cwd=superp)
+
+        client = imp.load_source('gift_client', clientp)
+        sockpath = pjoin(supergitp, "gift", "daemon.sock")
+        barhead = cmd0(giftp, "rev-parse", "HEAD", cwd=subbarp)
+
+        self.assertEqual(sockpath, client.find_sock(subbarp))
+        self.assertIsNone(client.request(sockpath, ["status"]), "no daemon")
+
+        # no daemon, run in process
+        self._gitoutput([clientp, "rev-parse", "HEAD"], [barhead], cwd=subbarp)
+
+        # a daemon started in background is not in the process group of
+        # the client
+        p = subprocess.Popen([giftp, "gift-daemon"], cwd=superp,
+                             stdout=subprocess.DEVNULL,
+                             stderr=subprocess.DEVNULL,
+                             start_new_session=True)
+        try:
+            for _ in range(100):
+                if os.path.exists(sockpath):
+                    break
+                time.sleep(0.1)
+
+            cwd = os.getcwd()
+            try:
+                os.chdir(subbarp)
+                rep = client.request(sockpath, ["status", "--sub"])
+                self.assertEqual({"code": 0}, rep, "run by daemon")
+
+                # git command in a sub is run by client
+                rep = client.request(sockpath, ["rev-parse", "-q", "--verify", "nonexistent"])
+                self.assertEqual(["rev-parse", "-q", "--verify", "nonexistent"], rep["exec"][-4:])
+                self.assertEqual(subbarp, rep["cwd"])
+                self.assertNotIn("post", rep)
+
+                os.chdir(superp)
+                rep = client.request(sockpath, ["log", "-1"])
+                self.assertEqual({"exec": ["git", "log", "-1"]}, rep,
+                                 "let client exec git")
+
+                # a command that may move super HEAD is finished by daemon
+                rep = client.request(sockpath, ["checkout", "-q", "HEAD"])
+                self.assertEqual(["checkout", "-q", "HEAD"], rep["exec"][-3:])
+                self.assertIn("post", rep)
+            finally:
+                os.chdir(cwd)
+
+            self._gitoutput([clientp, "rev-parse", "HEAD"], [barhead], cwd=subbarp)
+            self._gitoutput([clientp, "log", "-1", "--format=%H"],
+                            [cmd0(origit, "rev-parse", "HEAD", cwd=superp)],
+                            cwd=superp)
+
+            code, out, err = cmdf(clientp, "rev-parse", "--verify", "nonexistent", cwd=subbarp)
+            self.assertEqual(128, code)
+            self.assertEqual([], out)
+            self.assertEqual(["fatal: Needed a single revision"], err)
+
+            # a sub commit made through daemon populates nothing wrong
+            self._add_file_to_subbar()
+            fwrite(pjoin(subbarp, "newbar2"), "newbar2")
+            cmdx(clientp, "add", "newbar2", cwd=subbarp)
+            cmdx(clientp, *ident_args, "commit", "-m", "add newbar2", cwd=subbarp)
+            self._gitoutput([giftp, "log", "-1", "--format=%s"], ["add newbar2"], cwd=subbarp)
+
+            # an editor is run in the process group of the client
+            editor = ("{} -c 'import os, sys; "
+                      "open(sys.argv[1], \"w\").write(\"pgrp %d\" % os.getpgrp())'").format(sys.executable)
+            cmdx(clientp, *ident_args, "commit", "--allow-empty", cwd=superp,
+                 env={"GIT_EDITOR": editor})
+            self._gitoutput([giftp, "log", "-1", "--format=%s"], ["pgrp %d" % os.getpgrp()], cwd=superp)
+
+            # super/head of sub is populated after super HEAD moves
+            subgit = [origit, "--git-dir=" + pjoin(supergitp, "gift", "subdir", "foo", "bar")]
+            cmdx(giftp, *ident_args, "commit", "--sub", cwd=superp)
+            pinned1 = cmd0(*subgit, "rev-parse", "super/head")
+
+            cmdx(giftp, *ident_args, "commit", "--allow-empty", "-m", "empty", cwd=subbarp)
+            cmdx(giftp, *ident_args, "commit", "--sub", cwd=superp)
+            pinned2 = cmd0(*subgit, "rev-parse", "super/head")
+            self.assertNotEqual(pinned1, pinned2)
+
+            cmdx(clientp, "checkout", "-q", "HEAD~1", cwd=superp)
+            self._gitoutput([*subgit, "rev-parse", "super/head"], [pinned1])
+            cmdx(clientp, "checkout", "-q", "-", cwd=superp)
+            self._gitoutput([*subgit, "rev-parse", "super/head"], [pinned2])
+
+            cmdx(giftp, "gift-daemon", "stop", cwd=superp)
+            self.assertEqual(0, p.wait(timeout=10))
+        finally:
+            if p.poll() is None:
+                p.kill()
+                p.wait()
+
+        self.assertFalse(os.path.exists(sockpath))
+
+        code, _, err = cmdf(giftp, "gift-daemon", "stop", cwd=superp)
+        self.assertEqual(2, code)
+        self.assertEqual(["no daemon is running on " + sockpath], err)
 
 
 def force_remove(fn):